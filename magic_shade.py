@@ -4,12 +4,19 @@ import os
 import sys
 
 import maya.OpenMayaUI as mui
+import maya.api.OpenMaya as om
 import maya.cmds as cmds
 from PySide2.QtCore import *
 from PySide2.QtGui import *
 from PySide2.QtWidgets import *
 from shiboken2 import wrapInstance
 
+# Shared spell casting code lives next to this script in the install folder
+SCRIPT_DIR = os.path.expanduser("~/maya/scripts/magic-shade")
+if SCRIPT_DIR not in sys.path:
+    sys.path.append(SCRIPT_DIR)
+import spellcasting
+
 SCRIPT_NAME = "Magic Shade"
 
 
@@ -35,7 +42,8 @@ class MainUI(QMainWindow):
     shader_list = cmds.ls(materials=True)
     object_list_model = QStringListModel(cmds.ls(geometry=True))
     object_list = cmds.ls(geometry=True)
-    types_model = QStringListModel(["Shader", "Object"])
+    attribute_list_model = QStringListModel(["aiOpaque=0", "visibility=0", "aiSubdivType=1", "aiSubdivIterations=2"])
+    types_model = QStringListModel(spellcasting.SPELL_TYPES)
 
     # --------------------------------------------------------------------------------------------------------------
     # Property containing the current file being operated on. Automatically changes the window title
@@ -75,6 +83,7 @@ class MainUI(QMainWindow):
         self.create_toolbar()  # Initialize toolbar
         self.create_controls()  # Initializes controls
         self.create_layout()  # Initializes the internal window layout
+        self.create_scene_callbacks()  # Keeps the combo box models up to date with the scene
 
         # If we have a last-opened file saved in preferences, automatically open that file. Otherwise, just open
         # a new, empty file
@@ -205,9 +214,32 @@ class MainUI(QMainWindow):
         cast_all_spells_action.setStatusTip("Cast all spells")
         cast_all_spells_action.triggered.connect(self.cast_all_spells)  # Connect action
 
+        # Create the "Clean Up After Cast" action
+        self.clean_up_action = QAction("Clean &Up After Cast", self)
+        self.clean_up_action.setCheckable(True)
+        self.clean_up_action.setChecked(True)
+        self.clean_up_action.setStatusTip("Delete shaders and shading groups left unused by a cast")
+
+        # Create the "Verify Cast" action
+        verify_spells_action = QAction("&Verify Cast Against Legacy", self)
+        verify_spells_action.setStatusTip("Cast all spells with the legacy and current engines and compare results")
+        verify_spells_action.triggered.connect(self.verify_all_spells)  # Connect action
+
+        # Create the "Trace cmds Calls" action
+        self.trace_action = QAction("&Trace cmds Calls", self)
+        self.trace_action.setCheckable(True)
+        self.trace_action.setStatusTip("Record every Maya command until unchecked, then export a trace")
+        self.trace_action.toggled.connect(self.toggle_tracing)  # Connect action
+        spellcasting.tracing_listeners.append(self.tracing_changed)  # Disabled while Vehicular is tracing
+        self.tracing_changed()
+
         cast_menu = self.menu_bar.addMenu("&Cast")  # Add the cast menu to the menu bar
         cast_menu.addAction(cast_spells_action)  # Add the "Cast Selected Spell(s)" action to the cast menu
         cast_menu.addAction(cast_all_spells_action)  # Add the "Cast All Spells" action to the cast menu
+        cast_menu.addSeparator()  # Add a visual separator to the cast menu
+        cast_menu.addAction(self.clean_up_action)  # Add the "Clean Up After Cast" action to the cast menu
+        cast_menu.addAction(verify_spells_action)  # Add the "Verify Cast" action to the cast menu
+        cast_menu.addAction(self.trace_action)  # Add the "Trace cmds Calls" action to the cast menu
         # endregion
 
     # --------------------------------------------------------------------------------------------------------------
@@ -330,11 +362,8 @@ class MainUI(QMainWindow):
         self.spell_table.setRowCount(0)  # Clear the current spell table
         self.reset_shaders()  # Reset the shader list to existing shaders
 
-        with open(path) as f:
-            data = f.read().splitlines()
-            for spell in data:
-                spell_split = spell.split(":")
-                self.add_spell(spell_split[0], spell_split[1], spell_split[2])
+        for original, replacement, spell_type in spellcasting.read_spellbook(path):
+            self.add_spell(original, replacement, spell_type)
 
         self.current_file = path
         self.save_last_file(path)
@@ -344,7 +373,7 @@ class MainUI(QMainWindow):
     # --------------------------------------------------------------------------------------------------------------
     def save_spellbook(self):
         print("Save spellbook")
-        if self.current_file is None:
+        if self.current_file is None or not self.can_overwrite(self.current_file):
             self.save_spellbook_as()
         else:
             self.save_spellbook_to_file(self.current_file)
@@ -357,9 +386,24 @@ class MainUI(QMainWindow):
         file_path = QFileDialog.getSaveFileName(None, "", self.spellbook_dir, "Spellbooks (*.spb)")[0]
         if file_path == "":
             return
+        if not self.can_overwrite(file_path):
+            return
 
         self.save_spellbook_to_file(file_path)
 
+    # --------------------------------------------------------------------------------------------------------------
+    # Returns whether the current spells can be saved to a path. Spellbooks with includes or comments are shown with
+    # their includes resolved, so saving over them would flatten them; the user is warned instead.
+    # --------------------------------------------------------------------------------------------------------------
+    def can_overwrite(self, path):
+        if not os.path.isfile(path) or spellcasting.is_flat_spellbook(path):
+            return True
+        warning_box = QMessageBox(QMessageBox.Warning, "Spellbook Has Includes",
+                                  "%s includes other spellbooks or has comments, which saving would remove. "
+                                  "Please save to a new file or edit it in a text editor." % ntpath.basename(path))
+        warning_box.exec_()
+        return False
+
     # --------------------------------------------------------------------------------------------------------------
     # Saves the current spellbook to a file
     # --------------------------------------------------------------------------------------------------------------
@@ -371,6 +415,7 @@ class MainUI(QMainWindow):
                 spell_type = self.spell_table.cellWidget(row, 2).currentText()
                 f.write("%s:%s:%s\n" % (original, replacement, spell_type))
             f.close()
+        spellcasting.spellbook_cache.clear()  # Any cached spellbook may include the one we just wrote
         self.current_file = path
         self.save_last_file(path)
 
@@ -392,38 +437,92 @@ class MainUI(QMainWindow):
                 f.close()
 
     # --------------------------------------------------------------------------------------------------------------
-    # Refreshes the combo box models
+    # Refreshes the combo box models when nodes are added, removed or renamed in the scene. Scene changes only restart
+    # a timer, so a burst of changes (e.g. importing a vehicle) results in a single refresh once it's over.
     # --------------------------------------------------------------------------------------------------------------
-    def refresh_models(self):
-        rows = self.sort_visually(range(0, self.spell_table.rowCount()))
-        current_selections = [[] for i in rows]
+    def create_scene_callbacks(self):
+        self.pending_renames = []  # (old name, new name) of nodes renamed since the last refresh
 
-        for row in rows:
-            current_selections[row] = [self.spell_table.cellWidget(row, 0).currentText(),
-                                       self.spell_table.cellWidget(row, 1).currentText(),
-                                       self.spell_table.cellWidget(row, 2).currentText()]
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(500)
+        self.refresh_timer.timeout.connect(self.refresh_models)
+
+        self.callback_ids = [
+            om.MDGMessage.addNodeAddedCallback(self.scene_changed, "dependNode"),
+            om.MDGMessage.addNodeRemovedCallback(self.scene_changed, "dependNode"),
+            om.MNodeMessage.addNameChangedCallback(om.MObject.kNullObj, self.node_renamed),
+        ]
+
+    def scene_changed(self, *args):
+        self.refresh_timer.start()  # Restarts the timer if it's already running
 
-        old_shader_list = self.shader_list_model.stringList()
-        shader_diff = [x for x in old_shader_list if x not in self.shader_list]
-        old_object_list = self.object_list_model.stringList()
-        object_diff = [x for x in old_object_list if x not in self.object_list]
+    def node_renamed(self, node, old_name, *args):
+        self.pending_renames.append((old_name, om.MFnDependencyNode(node).name()))
+        self.refresh_timer.start()
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Removes the scene callbacks and stops any trace when the window is closed
+    # --------------------------------------------------------------------------------------------------------------
+    def closeEvent(self, event):
+        om.MMessage.removeCallbacks(self.callback_ids)
+        self.refresh_timer.stop()
+        spellcasting.tracing_listeners.remove(self.tracing_changed)
+        if spellcasting.stop_tracing(globals()) is not None:  # Otherwise every Python call in Maya stays profiled
+            print("Stopped tracing, the trace was discarded")
+        super(MainUI, self).closeEvent(event)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Refreshes the combo box models
+    # --------------------------------------------------------------------------------------------------------------
+    def refresh_models(self):
+        renames = self.pending_renames
+        self.pending_renames = []
 
         maya_materials_ls = cmds.ls(materials=True)
-        new_shader_list = maya_materials_ls + shader_diff
-        self.shader_list_model.setStringList(new_shader_list)
+        self.update_model(self.shader_list_model, self.shader_list, maya_materials_ls, renames)
         self.shader_list = maya_materials_ls
 
         maya_objects_ls = cmds.ls(geometry=True)
-        new_object_list = maya_objects_ls + object_diff
-        self.object_list_model.setStringList(new_object_list)
-        self.object_list = new_object_list
-
-        for index, row in enumerate(current_selections):
-            original_combo = self.spell_table.cellWidget(index, 0)
-            original_combo.setCurrentIndex(original_combo.findText(row[0]))
-
-            replacement_combo = self.spell_table.cellWidget(index, 1)
-            replacement_combo.setCurrentIndex(replacement_combo.findText(row[1]))
+        self.update_model(self.object_list_model, self.object_list, maya_objects_ls, renames)
+        self.object_list = maya_objects_ls
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Updates a combo box model in place from the old and new lists of scene nodes. Rows are inserted, removed and
+    # renamed rather than replacing the whole list, so combo boxes keep their current item without searching for it.
+    # Nodes that were removed from the scene stay in the model while a spell still uses them, as do entries that were
+    # never in the scene (e.g. from an opened spellbook).
+    # --------------------------------------------------------------------------------------------------------------
+    def update_model(self, model, old_scene_list, new_scene_list, renames):
+        rows = dict((name, row) for row, name in enumerate(model.stringList()))
+
+        # Renamed nodes keep their row, so combo boxes showing them follow the new name. Rows that weren't scene
+        # nodes (e.g. spell originals from a spellbook) just happen to share the name and are left alone.
+        old_scene_set = set(old_scene_list)
+        for old_name, new_name in renames:
+            if old_name in old_scene_set and old_name in rows and new_name not in rows:
+                model.setData(model.index(rows[old_name]), new_name)
+                rows[new_name] = rows.pop(old_name)
+
+        in_use = set()
+        for row in range(0, self.spell_table.rowCount()):
+            for column in (0, 1):
+                combo = self.spell_table.cellWidget(row, column)
+                if combo.model() is model:
+                    in_use.add(combo.currentText())
+
+        new_scene_set = set(new_scene_list)
+        removed_rows = [rows[name] for name in old_scene_set - new_scene_set
+                        if name in rows and name not in in_use]
+        for row in sorted(removed_rows, reverse=True):
+            model.removeRows(row, 1)
+
+        added = [name for name in new_scene_list if name not in rows]
+        if added:
+            first_row = model.rowCount()
+            model.insertRows(first_row, len(added))
+            for offset, name in enumerate(added):
+                model.setData(model.index(first_row + offset), name)
 
     # --------------------------------------------------------------------------------------------------------------
     # Resets the list of shaders shown in internal combo boxes to only existing shaders
@@ -445,7 +544,7 @@ class MainUI(QMainWindow):
         if spell_type is None:
             original_combo.setModel(self.shader_list_model)
         else:
-            if spell_type == "Object":
+            if spell_type in ("Object", "Attribute"):
                 original_combo.setModel(self.object_list_model)
             else:
                 original_combo.setModel(self.shader_list_model)
@@ -457,7 +556,10 @@ class MainUI(QMainWindow):
         self.spell_table.setCellWidget(row_num, 0, original_combo)
 
         replacement_combo = QComboBox()
-        replacement_combo.setModel(self.shader_list_model)
+        if spell_type == "Attribute":
+            replacement_combo.setModel(self.attribute_list_model)
+        else:
+            replacement_combo.setModel(self.shader_list_model)
         replacement_combo.setEditable(True)
         if replacement is not None:
             if replacement not in replacement_combo.model().stringList():
@@ -469,17 +571,23 @@ class MainUI(QMainWindow):
         type_combo.setModel(self.types_model)
         if spell_type is not None:
             type_combo.setCurrentIndex(type_combo.findText(spell_type))
-        type_combo.currentTextChanged.connect(lambda: self.change_type(original_combo, type_combo.currentText()))
+        type_combo.currentTextChanged.connect(
+            lambda: self.change_type(original_combo, replacement_combo, type_combo.currentText()))
         self.spell_table.setCellWidget(row_num, 2, type_combo)
 
-    def change_type(self, original_combo, value):
+    def change_type(self, original_combo, replacement_combo, value):
         print(str(original_combo) + "," + str(value))
         curr_text = original_combo.currentText()
         if curr_text != value:
             if value == "Shader":
                 original_combo.setModel(self.shader_list_model)
+                replacement_combo.setModel(self.shader_list_model)
             elif value == "Object":
                 original_combo.setModel(self.object_list_model)
+                replacement_combo.setModel(self.shader_list_model)
+            elif value == "Attribute":
+                original_combo.setModel(self.object_list_model)
+                replacement_combo.setModel(self.attribute_list_model)
 
     # --------------------------------------------------------------------------------------------------------------
     # Removes selected spells from the spell table
@@ -531,22 +639,79 @@ class MainUI(QMainWindow):
     def cast_spells_from_rows(self, rows):
         selection = cmds.ls(selection=True)
         cmds.select(deselect=True)
-        for row in rows:
-            original = self.spell_table.cellWidget(row, 0).currentText()
-            replacement = self.spell_table.cellWidget(row, 1).currentText()
-            spell_type = self.spell_table.cellWidget(row, 2).currentText()
-            print("Replacing " + original + " " + spell_type + " with " + replacement)
-            if spell_type == "Shader":
-                cmds.hyperShade(objects=original)
-            elif spell_type == "Object":
-                cmds.select(original, replace=True)
-            else:
-                raise ValueError(
-                    "Spell type invalid. Should be one of the following: " + str(self.types_model.stringList()))
-            cmds.hyperShade(assign=replacement)
-            cmds.select(deselect=True)
+        replaced_groups = spellcasting.cast_spell_list(self.spells_from_rows(rows))
+        if self.clean_up_action.isChecked():
+            spellcasting.delete_orphaned_shaders(replaced_groups)
         cmds.select(selection)
 
+    # --------------------------------------------------------------------------------------------------------------
+    # Casts all spells with both the legacy and current engines, undoing both, and reports any differences
+    # --------------------------------------------------------------------------------------------------------------
+    def verify_all_spells(self):
+        print("Verify all spells")
+        if not cmds.undoInfo(query=True, state=True):
+            warning_box = QMessageBox(QMessageBox.Warning, "Undo Disabled", "Verifying a cast requires undo.")
+            warning_box.exec_()
+            return
+        selection = cmds.ls(selection=True)
+        cmds.select(deselect=True)
+        spells = self.spells_from_rows(self.sort_visually(range(0, self.spell_table.rowCount())))
+        legacy_error, results = spellcasting.verify_cast(spells)
+        if selection:  # select with an empty list would fail
+            cmds.select(selection)
+
+        lines = []
+        if legacy_error is not None:
+            lines.append("The legacy cast failed: %s" % legacy_error)
+        for name, error, differences, time_ratio, call_ratio in results:
+            if error is not None:
+                result = "failed: %s" % error
+            elif differences is None:
+                result = "can't be compared"
+            elif differences:
+                result = "%d shader assignment(s) differ from the legacy cast" % len(differences)
+            else:
+                result = "shader assignments match the legacy cast"
+            lines.append("%s %s\nRun time: %.2fx legacy, cmds calls: %.2fx legacy" % (name, result, time_ratio,
+                                                                                     call_ratio))
+        lines.append("See the Script Editor for details.")
+        info_box = QMessageBox(QMessageBox.Information, "Verify Cast", "\n\n".join(lines))
+        info_box.exec_()
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Starts tracing cmds calls, or stops tracing and exports the trace based on user input
+    # --------------------------------------------------------------------------------------------------------------
+    def toggle_tracing(self, checked):
+        if checked:
+            print("Start tracing")
+            if not spellcasting.start_tracing(globals()):
+                cmds.warning("Another tool is already tracing cmds calls")
+                self.trace_action.setChecked(False)
+            return
+
+        tracer = spellcasting.stop_tracing(globals())
+        if tracer is None:  # Unchecked because tracing couldn't start
+            return
+        print("Stop tracing")
+        file_path = QFileDialog.getSaveFileName(None, "", "", "Chrome Trace (*.json)")[0]
+        if file_path == "":
+            return
+        tracer.export(file_path)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Only lets tracing be toggled while no other tool is tracing
+    # --------------------------------------------------------------------------------------------------------------
+    def tracing_changed(self):
+        self.trace_action.setEnabled(not spellcasting.is_tracing() or spellcasting.is_tracing(globals()))
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Returns a list of (original, replacement, type) spells from rows
+    # --------------------------------------------------------------------------------------------------------------
+    def spells_from_rows(self, rows):
+        return [(self.spell_table.cellWidget(row, 0).currentText(),
+                 self.spell_table.cellWidget(row, 1).currentText(),
+                 self.spell_table.cellWidget(row, 2).currentText()) for row in rows]
+
     # --------------------------------------------------------------------------------------------------------------
     # Returns a list of selected rows in the spell table
     # --------------------------------------------------------------------------------------------------------------
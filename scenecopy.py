@@ -0,0 +1,90 @@
+import collections
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+
+import maya.cmds as cmds
+import maya.utils
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns the MD5 checksum of a file, read in chunks so large scenes don't have to fit in memory
+# ----------------------------------------------------------------------------------------------------------------------
+def file_checksum(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Copies a saved scene from local scratch to its destination and verifies the copy against the original's checksum,
+# retrying if either fails. The copy is written next to the destination and only renamed into place once verified, so
+# the destination never holds a partial scene. The scratch copy is removed once verified and kept if every attempt
+# fails. Meant to be run on a background thread, so results are reported back on Maya's main thread.
+# ----------------------------------------------------------------------------------------------------------------------
+def copy_verified(source, destination, attempts=3, retry_delay=5):
+    temp_destination = destination + ".tmp"
+    for attempt in range(1, attempts + 1):
+        try:
+            source_checksum = file_checksum(source)  # Inside the try so a locked or missing scratch file is retried
+            shutil.copyfile(source, temp_destination)
+            if file_checksum(temp_destination) == source_checksum:
+                if os.path.exists(destination):  # os.rename can't replace an existing file on Windows
+                    os.remove(destination)
+                os.rename(temp_destination, destination)
+                shutil.rmtree(os.path.dirname(source), ignore_errors=True)
+                maya.utils.executeDeferred(sys.stdout.write, "Saved %s\n" % destination)
+                return
+            error = "checksum mismatch"
+        except (IOError, OSError) as e:
+            error = str(e)
+        if attempt < attempts:
+            time.sleep(retry_delay)
+
+    try:
+        os.remove(temp_destination)
+    except OSError:
+        pass
+    maya.utils.executeDeferred(cmds.warning, "Could not save %s (%s). The scene is still at %s" %
+                               (destination, error, source))
+
+
+copy_queue = collections.deque()  # (source, destination) of saved scenes waiting to be copied
+copy_lock = threading.Lock()
+copy_thread = None  # Thread working through copy_queue, if any
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Queues a saved scene to be copied to its destination. Copies run one at a time on a single background thread, so
+# saves to the same destination never race each other.
+# ----------------------------------------------------------------------------------------------------------------------
+def queue_copy(source, destination):
+    global copy_thread
+    with copy_lock:
+        copy_queue.append((source, destination))
+        if copy_thread is None:
+            copy_thread = threading.Thread(target=run_copy_queue)
+            copy_thread.start()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Copies queued scenes until the queue is empty, then lets the thread end so it never keeps Maya from quitting
+# ----------------------------------------------------------------------------------------------------------------------
+def run_copy_queue():
+    global copy_thread
+    while True:
+        with copy_lock:
+            if not copy_queue:
+                copy_thread = None
+                return
+            source, destination = copy_queue.popleft()
+        try:
+            copy_verified(source, destination)
+        except Exception as e:  # Keep copying the rest of the queue; a dead thread would strand every later save
+            maya.utils.executeDeferred(cmds.warning, "Could not save %s (%s). The scene is still at %s" %
+                                       (destination, e, source))
@@ -0,0 +1,684 @@
+import bisect
+import json
+import os
+import re
+import sys
+import time
+import timeit
+
+import maya.cmds as cmds
+
+SPELL_TYPES = ["Shader", "Object", "Attribute"]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Deletes the given shading groups if a cast has left them without members, along with any materials that are no
+# longer connected to a shading group and the texture and utility nodes only those materials used. Maya's default
+# shading groups are never touched.
+# ----------------------------------------------------------------------------------------------------------------------
+def delete_orphaned_shaders(shading_groups):
+    orphaned_groups = []
+    for shading_group in set(shading_groups):
+        if shading_group in ("initialShadingGroup", "initialParticleSE") or not cmds.objExists(shading_group):
+            continue
+        if not cmds.sets(shading_group, query=True):  # If nothing is assigned to the shading group anymore
+            orphaned_groups.append(shading_group)
+    if not orphaned_groups:
+        return
+
+    # Find the materials feeding the orphaned shading groups before the groups are deleted
+    inputs = cmds.listConnections(orphaned_groups, source=True, destination=False)
+    materials = cmds.ls(inputs, materials=True) if inputs else []  # ls with an empty list would list every material
+    cmds.delete(orphaned_groups)  # Delete all orphaned shading groups in one call
+
+    orphaned_materials = [material for material in set(materials)
+                          if not cmds.listConnections(material, type="shadingEngine")]
+    network = unused_shading_network(orphaned_materials) if orphaned_materials else []
+    if network:
+        cmds.delete(network)
+    deleted_materials = len(set(network) & set(orphaned_materials))  # Locked or default materials are kept
+    print("Deleted %d unused shading group(s), %d unused material(s) and %d texture/utility node(s)" % (
+        len(orphaned_groups), deleted_materials, len(network) - deleted_materials))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns the given materials along with every node upstream of them (textures, bump, placement...) that isn't
+# connected to anything else, other than Maya's bookkeeping nodes. Default nodes (e.g. defaultColorMgtGlobals, which
+# feeds every file texture) and locked nodes are never included.
+# ----------------------------------------------------------------------------------------------------------------------
+def unused_shading_network(materials):
+    history = cmds.listHistory(materials) or []
+    if not history:  # ls with an empty list would list every node in the scene
+        return []
+    kept_nodes = set(cmds.ls(history, dag=True) + cmds.ls(history, defaultNodes=True) +
+                     cmds.ls(history, lockedNodes=True))
+    upstream = set(history) - kept_nodes - set(materials)
+    ignored_types = ("defaultTextureList", "defaultRenderUtilityList", "defaultShaderList", "materialInfo",
+                     "hyperLayout", "nodeGraphEditorInfo")
+
+    network = set(materials) - kept_nodes
+    found_unused = True
+    while found_unused:  # Nodes further upstream become unused once everything they feed is in the network
+        found_unused = False
+        for node in upstream - network:
+            outputs = cmds.listConnections(node, source=False, destination=True) or []
+            if all(output in network or cmds.nodeType(output) in ignored_types for output in outputs):
+                network.add(node)
+                found_unused = True
+    return list(network)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns the shading groups that were replaced in a cast without the shading groups of the spells' replacement
+# shaders, so that cleaning up never deletes a shader the spells assign (e.g. one emptied again by a later spell)
+# ----------------------------------------------------------------------------------------------------------------------
+def without_replacement_groups(replaced_groups, spells):
+    replacements = set(replacement for original, replacement, spell_type in spells if spell_type != "Attribute")
+    materials = cmds.ls(list(replacements), materials=True) if replacements else []
+    protected_groups = set(cmds.listConnections(materials, type="shadingEngine") or []) if materials else set()
+    return [shading_group for shading_group in replaced_groups if shading_group not in protected_groups]
+
+
+spellbook_cache = {}  # Composed spellbooks keyed by absolute path, along with the files they were read from
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns the key a spell overrides included spells by: its original and type, plus the attribute for Attribute spells
+# so that spells setting different attributes on the same objects don't replace each other
+# ----------------------------------------------------------------------------------------------------------------------
+def override_key(spell):
+    original, replacement, spell_type = spell
+    if spell_type == "Attribute":
+        return original, spell_type, replacement.split("=", 1)[0]
+    return original, spell_type
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Reads the spells of a spellbook file. A line of the form "include:<path>" reads the spells of another spellbook in its
+# place (relative paths are relative to the including spellbook), and a later spell in the including file with the same
+# override key replaces an included spell in place. Spells in the same file never replace each other. Blank lines and
+# lines starting with "#" are skipped. The modification time and size of every file read is recorded in files.
+# ----------------------------------------------------------------------------------------------------------------------
+def compose_spellbook(path, files, including=()):
+    path = os.path.abspath(path)
+    if path in including:
+        raise ValueError("Spellbook includes itself: " + path)
+    files[path] = (os.path.getmtime(path), os.path.getsize(path))
+    spells = []
+    included_positions = {}  # Position of the last included spell with each override key
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            if line.startswith("include:"):  # The path may contain ":" itself, e.g. C:/spellbooks/base.spb
+                include_path = os.path.join(os.path.dirname(path), line[len("include:"):])
+                for spell in compose_spellbook(include_path, files, including + (path,)):
+                    included_positions[override_key(spell)] = len(spells)
+                    spells.append(spell)
+                continue
+            spell_split = line.split(":")
+            spell = (spell_split[0], spell_split[1], spell_split[2])
+            position = included_positions.pop(override_key(spell), None)
+            if position is not None:  # If this spell replaces the same original as an included one, override it
+                spells[position] = spell
+            else:
+                spells.append(spell)
+    return spells
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns whether a spellbook file only contains spells, i.e. no includes or comments that saving the spells shown in
+# Magic Shade would lose
+# ----------------------------------------------------------------------------------------------------------------------
+def is_flat_spellbook(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("include:") or line.startswith("#"):
+                return False
+    return True
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns the list of (original, replacement, type) spells in a spellbook with all includes resolved. Composed
+# spellbooks are cached until one of their files changes on disk.
+# ----------------------------------------------------------------------------------------------------------------------
+def read_spellbook(path):
+    path = os.path.abspath(path)
+    if path in spellbook_cache:
+        files, spells = spellbook_cache[path]
+        try:
+            if all((os.path.getmtime(p), os.path.getsize(p)) == stat for p, stat in files.items()):
+                return spells
+        except OSError:  # If one of the files was removed, read the spellbook again to report it
+            pass
+
+    files = {}
+    spells = compose_spellbook(path, files)
+    spellbook_cache[path] = (files, spells)
+    return spells
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Casts an "Attribute" spell. The assignment has the form "<attribute>=<value>" (e.g. "aiOpaque=0") and is set on
+# every object matching the original pattern, everything below those objects and every shape using a material that
+# matches the pattern, wherever the attribute exists. With match_objects False only the shapes using a matching
+# material are set, the way hyperShade selects objects by shader. All plugs are resolved up front without touching the
+# selection and written in one pass.
+# ----------------------------------------------------------------------------------------------------------------------
+def cast_attribute_spell(original, assignment, match_objects=True):
+    # ls and listConnections treat an empty list as "everything", so every lookup stops at the first empty result
+    nodes = (cmds.ls(original, dag=True, long=True) or []) if match_objects else []
+    materials = cmds.ls(original, materials=True)
+    for shading_group in set(shading_group for material in materials for shading_group in
+                             surface_shading_groups(material)):
+        members = cmds.sets(shading_group, query=True)
+        if members:
+            nodes.extend(cmds.ls(members, objectsOnly=True, long=True))
+    set_attribute(nodes, assignment)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Sets an "<attribute>=<value>" assignment on every node that has the attribute
+# ----------------------------------------------------------------------------------------------------------------------
+def set_attribute(nodes, assignment):
+    attribute, value = assignment.split("=", 1)
+    if value.lower() in ("true", "false"):
+        value = value.lower() == "true"
+    else:
+        for value_type in (int, float):
+            try:
+                value = value_type(value)
+                break
+            except ValueError:
+                pass
+
+    if not nodes:
+        return
+    plugs = cmds.ls(["%s.%s" % (node, attribute) for node in set(nodes)])  # Only keeps plugs that exist
+    for plug in plugs:
+        if isinstance(value, (bool, int, float)):
+            cmds.setAttr(plug, value)
+        else:
+            cmds.setAttr(plug, value, type="string")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Converts a Maya name pattern (one component of a DAG path) to a regular expression. As in Maya, wildcards don't match
+# across namespaces.
+# ----------------------------------------------------------------------------------------------------------------------
+def name_pattern_to_regex(pattern):
+    regex = ""
+    for character in pattern:
+        if character == "*":
+            regex += "[^:]*"
+        elif character == "?":
+            regex += "[^:]"
+        else:
+            regex += re.escape(character)
+    return re.compile(regex + "$")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Index of the scene's DAG hierarchy, built with a single ls call, that Object spells are matched against instead of
+# going through the selection list. Patterns may be scoped with DAG path separators, e.g. "Vehicle|*|*tire*" matches
+# every *tire* grandchild of a node named Vehicle, and "|Vehicle1|*" only matches children of the top-level Vehicle1.
+# ----------------------------------------------------------------------------------------------------------------------
+class DagIndex(object):
+    def __init__(self):
+        self.paths = sorted(cmds.ls(dag=True, long=True) or [])
+        self.shapes = set(cmds.ls(dag=True, long=True, shapes=True, noIntermediate=True) or [])
+        self.paths_by_name = {}
+        for path in self.paths:
+            self.paths_by_name.setdefault(path.rsplit("|", 1)[-1], []).append(path)
+
+    # Returns the full paths of every node below a full path
+    def descendants(self, path):
+        start = bisect.bisect_left(self.paths, path + "|")
+        end = bisect.bisect_left(self.paths, path + "}")  # "}" sorts right after "|"
+        return self.paths[start:end]
+
+    # Returns the full paths of every node matching a (possibly scoped) name pattern, optionally only below root
+    def match(self, pattern, root=None):
+        anchored = pattern.startswith("|")
+        names = pattern.strip("|").split("|")
+        regexes = [name_pattern_to_regex(name) for name in names]
+
+        # Only look at the part of the scene the pattern can match: nodes with the right name if the last name is
+        # literal, or the hierarchies below nodes with the right name if the first one is
+        if "*" not in names[-1] and "?" not in names[-1]:
+            candidates = self.paths_by_name.get(names[-1], [])
+        elif "*" not in names[0] and "?" not in names[0]:
+            candidates = set()
+            for named_path in self.paths_by_name.get(names[0], []):
+                candidates.update(self.descendants(named_path))
+        elif root is not None:
+            candidates = self.descendants(root)
+        else:
+            candidates = self.paths
+        if root is not None:
+            candidates = [path for path in candidates if path.startswith(root + "|")]
+
+        matches = []
+        for path in candidates:
+            path_names = path.lstrip("|").split("|")
+            if len(path_names) < len(names) or (anchored and len(path_names) != len(names)):
+                continue
+            if all(regex.match(name) for regex, name in zip(regexes, path_names[-len(names):])):
+                matches.append(path)
+        return matches
+
+    # Returns the full paths of every shape at or below the given full paths
+    def shapes_under(self, paths):
+        shapes = set()
+        for path in paths:
+            if path in self.shapes:
+                shapes.add(path)
+            shapes.update(descendant for descendant in self.descendants(path) if descendant in self.shapes)
+        return sorted(shapes)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns the shading groups a material is the surface shader of, leaving out ones it's only a displacement or volume
+# input to
+# ----------------------------------------------------------------------------------------------------------------------
+def surface_shading_groups(material):
+    plugs = cmds.listConnections(material + ".outColor", type="shadingEngine", source=False, destination=True,
+                                 plugs=True) or []
+    return [plug.split(".", 1)[0] for plug in plugs if plug.endswith(".surfaceShader")]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Assigns a shader to objects without touching the selection, falling back to hyperShade if the shader doesn't have a
+# shading group yet
+# ----------------------------------------------------------------------------------------------------------------------
+def assign_shader(objects, replacement):
+    materials = cmds.ls(replacement, materials=True)
+    shading_groups = surface_shading_groups(materials[0]) if materials else None
+    if shading_groups:
+        cmds.sets(objects, edit=True, forceElement=shading_groups[0])
+    else:
+        cmds.select(objects, replace=True)
+        cmds.hyperShade(assign=replacement)
+        cmds.select(deselect=True)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Casts a list of (original, replacement, type) spells in order. Returns the shading groups that were assigned to the
+# replaced objects (other than the replacements') so they can be cleaned up afterwards. Expects nothing to be selected.
+# ----------------------------------------------------------------------------------------------------------------------
+def cast_spell_list(spells):
+    replaced_groups = []
+    dag_index = None  # Built on the first Object spell; casting doesn't change the hierarchy
+    for original, replacement, spell_type in spells:
+        print("Replacing " + original + " " + spell_type + " with " + replacement)
+        if spell_type == "Attribute":
+            cast_attribute_spell(original, replacement)
+            continue
+        if spell_type == "Object":
+            if dag_index is None:
+                dag_index = DagIndex()
+            shapes = dag_index.shapes_under(dag_index.match(original))
+            if shapes:
+                replaced_groups.extend(cmds.listConnections(shapes, type="shadingEngine") or [])
+                assign_shader(shapes, replacement)
+            continue
+        if spell_type == "Shader":
+            cmds.hyperShade(objects=original)
+        else:
+            raise ValueError("Spell type invalid. Should be one of the following: " + str(SPELL_TYPES))
+        # Remember the shading groups currently on the matched objects so they can be cleaned up after the cast
+        replaced_groups.extend(cmds.listConnections(cmds.ls(selection=True, objectsOnly=True),
+                                                    type="shadingEngine") or [])
+        cmds.hyperShade(assign=replacement)
+        cmds.select(deselect=True)
+    return without_replacement_groups(replaced_groups, spells)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns the shading group of the shader matching a pattern, creating one if the shader doesn't have one yet. Returns
+# None if no shader matches.
+# ----------------------------------------------------------------------------------------------------------------------
+def shading_group_for(replacement):
+    materials = cmds.ls(replacement, materials=True)
+    if not materials:
+        return None
+    shading_groups = surface_shading_groups(materials[0])
+    if shading_groups:
+        return shading_groups[0]
+    shading_group = cmds.sets(renderable=True, noSurfaceShader=True, empty=True, name=materials[0] + "SG")
+    cmds.connectAttr(materials[0] + ".outColor", shading_group + ".surfaceShader")
+    return shading_group
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Casts a different list of spells on each group in one pass over the scene. spellbooks_by_group maps the full path of
+# each group to its spells. The hierarchy and every shape's shading groups are read once up front and kept up to date
+# as spells are cast, so each spell only looks at the shapes in its own group. Returns the shading groups that were
+# assigned to the replaced objects (other than the replacements') so they can be cleaned up afterwards.
+# ----------------------------------------------------------------------------------------------------------------------
+def cast_spellbooks_by_group(spellbooks_by_group):
+    dag_index = DagIndex()
+
+    # Map every shape to its shading group members (the whole shape or some of its faces) and their shading groups
+    assignments = {}
+    materials = {}
+    for shading_group in cmds.ls(type="shadingEngine"):
+        materials[shading_group] = (cmds.listConnections(shading_group + ".surfaceShader", source=True,
+                                                         destination=False) or [""])[0]
+        members = cmds.sets(shading_group, query=True)
+        if not members:  # ls with an empty list would list every node in the scene
+            continue
+        for member in cmds.ls(members, long=True):
+            assignments.setdefault(member.split(".", 1)[0], {})[member] = shading_group
+
+    replaced_groups = []
+    replacement_groups = {}  # Shading group of each replacement, looked up once per cast
+    for group, spells in spellbooks_by_group.items():
+        group_shapes = dag_index.shapes_under([group])
+        for original, replacement, spell_type in spells:
+            print("Replacing " + original + " " + spell_type + " with " + replacement + " in " + group)
+            if spell_type == "Shader" or spell_type == "Attribute":
+                material_regex = name_pattern_to_regex(original)
+                members = [member for shape in group_shapes for member, shading_group in
+                           assignments.get(shape, {}).items() if material_regex.match(materials[shading_group])]
+            if spell_type == "Attribute":  # Matches the same nodes as cast_attribute_spell, limited to the group
+                matches = dag_index.match(original, group)
+                set_attribute(matches + [descendant for path in matches for descendant in dag_index.descendants(path)]
+                              + [member.split(".", 1)[0] for member in members], replacement)
+                continue
+            if spell_type == "Object":
+                members = dag_index.shapes_under(dag_index.match(original, group))
+            elif spell_type != "Shader":
+                raise ValueError("Spell type invalid. Should be one of the following: " + str(SPELL_TYPES))
+            if not members:
+                continue
+
+            if replacement not in replacement_groups:
+                replacement_groups[replacement] = shading_group_for(replacement)
+                if replacement_groups[replacement] is not None:
+                    materials[replacement_groups[replacement]] = cmds.ls(replacement, materials=True)[0]
+            new_group = replacement_groups[replacement]
+            if new_group is None:
+                cmds.warning("No shader matches " + replacement)
+                continue
+
+            cmds.sets(members, edit=True, forceElement=new_group)
+            for member in members:  # Keep the assignments up to date for later spells
+                shape_assignments = assignments.setdefault(member.split(".", 1)[0], {})
+                if "." not in member:  # Assigning the whole shape replaces any per-face assignments
+                    replaced_groups.extend(shape_assignments.values())
+                    shape_assignments.clear()
+                elif member in shape_assignments:
+                    replaced_groups.append(shape_assignments[member])
+                shape_assignments[member] = new_group
+    return without_replacement_groups(replaced_groups, [spell for spells in spellbooks_by_group.values()
+                                                        for spell in spells])
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Casts spells exactly the way Magic Shade originally did, one selection and hyperShade assignment per spell. Kept as
+# the reference that cast_spell_list is verified against, so don't optimize it.
+# ----------------------------------------------------------------------------------------------------------------------
+def cast_spell_list_legacy(spells):
+    for original, replacement, spell_type in spells:
+        if spell_type == "Shader":
+            cmds.hyperShade(objects=original)
+        elif spell_type == "Object":
+            cmds.select(original, replace=True)
+        else:
+            continue  # Other spell types didn't exist yet and don't assign shaders
+        cmds.hyperShade(assign=replacement)
+        cmds.select(deselect=True)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Stands in for maya.cmds and counts every command called through it
+# ----------------------------------------------------------------------------------------------------------------------
+class CountingCmds(object):
+    def __init__(self, module):
+        self.module = module
+        self.calls = 0
+
+    def __getattr__(self, name):
+        command = getattr(self.module, name)
+
+        def counted_command(*args, **kwargs):
+            self.calls += 1
+            return command(*args, **kwargs)
+
+        return counted_command
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns a dictionary mapping every shading group member (shape or face components) to its material
+# ----------------------------------------------------------------------------------------------------------------------
+def shader_assignments():
+    assignments = {}
+    for shading_group in cmds.ls(type="shadingEngine"):
+        materials = cmds.listConnections(shading_group + ".surfaceShader", source=True, destination=False) or [None]
+        for member in cmds.sets(shading_group, query=True) or []:
+            assignments[member] = materials[0]
+    return assignments
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Runs a cast engine on the current scene inside an undo chunk, records the resulting shader assignments, then undoes
+# the cast. The cast is undone even if the engine fails, which is reported instead of raised. Returns the assignments
+# (None if the engine failed), the run time in seconds, the number of cmds calls made and the error, if any.
+# ----------------------------------------------------------------------------------------------------------------------
+def run_cast_engine(engine, spells):
+    global cmds
+    counting_cmds = CountingCmds(cmds)
+    assignments = None
+    error = None
+    cmds.undoInfo(openChunk=True)
+    try:
+        cmds = counting_cmds
+        start = time.time()
+        try:
+            engine(spells)
+        except Exception as e:  # Reported with the results so the other engines still get compared
+            error = e
+        run_time = time.time() - start
+        cmds = counting_cmds.module
+        if error is None:
+            assignments = shader_assignments()
+    finally:
+        cmds = counting_cmds.module
+        cmds.undoInfo(closeChunk=True)
+        cmds.undo()
+        cmds.select(deselect=True)
+    return assignments, run_time, counting_cmds.calls, error
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Casts spells on every top-level group of the scene with cast_spellbooks_by_group, so it can be verified against the
+# engines that cast on the whole scene
+# ----------------------------------------------------------------------------------------------------------------------
+def cast_spell_list_by_group(spells):
+    return cast_spellbooks_by_group(dict((group, spells) for group in cmds.ls(assemblies=True, long=True) or []))
+
+
+VERIFIED_ENGINES = [("cast_spell_list", cast_spell_list), ("cast_spellbooks_by_group", cast_spell_list_by_group)]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Casts spells on the current scene with the legacy engine and each of the current engines, undoing each, and compares
+# the resulting shader assignments. Returns the legacy engine's error (None if it succeeded) and a list of (engine
+# name, error, differences, run time ratio, cmds call ratio) results, where differences is a list of (member, legacy
+# material, new material) tuples, or None if either engine failed. Ratios are new / legacy.
+# ----------------------------------------------------------------------------------------------------------------------
+def verify_cast(spells):
+    legacy_assignments, legacy_time, legacy_calls, legacy_error = run_cast_engine(cast_spell_list_legacy, spells)
+    print("Legacy cast: %.3fs, %d cmds calls" % (legacy_time, legacy_calls))
+    if legacy_error is not None:
+        print("Legacy cast failed: %s" % legacy_error)
+
+    results = []
+    for name, engine in VERIFIED_ENGINES:
+        new_assignments, new_time, new_calls, error = run_cast_engine(engine, spells)
+        print("%s: %.3fs, %d cmds calls" % (name, new_time, new_calls))
+        differences = None
+        if error is not None:
+            print("%s failed: %s" % (name, error))
+        elif legacy_error is None:
+            differences = []
+            for member in sorted(set(legacy_assignments) | set(new_assignments)):
+                legacy_material = legacy_assignments.get(member)
+                new_material = new_assignments.get(member)
+                if legacy_material != new_material:
+                    differences.append((member, legacy_material, new_material))
+                    print("Mismatch on %s: legacy %s, %s %s" % (member, legacy_material, name, new_material))
+
+        time_ratio = new_time / legacy_time if legacy_time else 1.0
+        call_ratio = float(new_calls) / legacy_calls if legacy_calls else 1.0
+        results.append((name, error, differences, time_ratio, call_ratio))
+    return legacy_error, results
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns a short representation of a command argument for traces, abbreviating long lists such as node lists
+# ----------------------------------------------------------------------------------------------------------------------
+def short_repr(value, max_items=5):
+    if isinstance(value, (list, tuple)) and len(value) > max_items:
+        return "[%s, ... %d more]" % (", ".join(repr(item) for item in value[:max_items]), len(value) - max_items)
+    return repr(value)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Stands in for maya.cmds while tracing and times every command called through it, along with the functions of this
+# module and the calling script they were called from (through sys.setprofile). Exports Chrome trace events
+# (chrome://tracing, Perfetto) and collapsed stacks (flamegraph.pl, speedscope). Arguments are truncated and only the
+# first max_events calls are kept as trace events, but every call counts towards the collapsed stacks.
+# ----------------------------------------------------------------------------------------------------------------------
+class CmdsTracer(object):
+    def __init__(self, module, script_globals, max_events=200000, max_args_length=200):
+        self.module = module
+        self.max_events = max_events
+        self.max_args_length = max_args_length
+        self.script_globals = script_globals
+        self.traced_globals = set([id(globals()), id(script_globals)])
+        self.events = []
+        self.dropped_events = 0
+        self.folded = {}  # Self time in microseconds of each ";"-separated call stack
+        self.stack = []  # [name, start, time spent in children] of each open call
+
+        # Don't trace the tracer itself, including its comprehensions and nested functions
+        self.ignored_code = set()
+        code_objects = [short_repr.__code__] + [function.__code__ for function in CmdsTracer.__dict__.values()
+                                                if hasattr(function, "__code__")]
+        while code_objects:
+            code = code_objects.pop()
+            self.ignored_code.add(code)
+            code_objects.extend(const for const in code.co_consts if hasattr(const, "co_code"))
+
+    def __getattr__(self, name):
+        command = getattr(self.module, name)
+
+        def traced_command(*args, **kwargs):
+            arguments = [short_repr(arg) for arg in args]
+            arguments.extend("%s=%s" % (key, short_repr(value)) for key, value in sorted(kwargs.items()))
+            arguments = ", ".join(arguments)
+            if len(arguments) > self.max_args_length:
+                arguments = arguments[:self.max_args_length] + "..."
+            self.begin("cmds." + name)
+            try:
+                return command(*args, **kwargs)
+            finally:
+                self.end(arguments)
+
+        return traced_command
+
+    # Called by sys.setprofile on every function call and return
+    def profile(self, frame, event, arg):
+        if id(frame.f_globals) not in self.traced_globals or frame.f_code in self.ignored_code:
+            return
+        if event == "call":
+            name = frame.f_code.co_name
+            if "self" in frame.f_code.co_varnames[:1]:  # Name methods after their class, e.g. MainUI.save
+                name = type(frame.f_locals["self"]).__name__ + "." + name
+            self.begin(name)
+        elif event == "return" and self.stack:  # Calls that started before tracing have nothing to end
+            self.end()
+
+    def begin(self, name):
+        self.stack.append([name, timeit.default_timer() * 1000000, 0.0])
+
+    def end(self, arguments=None):
+        name, start, child_time = self.stack.pop()
+        duration = timeit.default_timer() * 1000000 - start
+        if self.stack:
+            self.stack[-1][2] += duration
+
+        folded_stack = ";".join([call[0] for call in self.stack] + [name])
+        self.folded[folded_stack] = self.folded.get(folded_stack, 0.0) + duration - child_time
+        if len(self.events) < self.max_events:
+            event = {"name": name, "ph": "X", "ts": start, "dur": duration, "pid": 1, "tid": 1}
+            if arguments is not None:
+                event["args"] = {"args": arguments}
+            self.events.append(event)
+        else:
+            self.dropped_events += 1
+
+    # Ends any calls still open, e.g. the one that stopped tracing
+    def finish(self):
+        while self.stack:
+            self.end()
+
+    # Writes <path>.json with Chrome trace events and <path>.folded with collapsed stacks
+    def export(self, path):
+        path = os.path.splitext(path)[0]
+        with open(path + ".json", "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        with open(path + ".folded", "w") as f:
+            for folded_stack, self_time in sorted(self.folded.items()):
+                f.write("%s %d\n" % (folded_stack, int(round(self_time))))
+        if self.dropped_events:
+            print("Trace event limit reached, %d calls only appear in %s.folded" % (self.dropped_events, path))
+
+
+tracing_listeners = []  # Functions called whenever tracing starts or stops, e.g. to update each tool's toggle
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Starts tracing every cmds call made by this module and by the script whose globals are given. Only one script can
+# trace at a time, so returns False without tracing if another script (or this one) already is.
+# ----------------------------------------------------------------------------------------------------------------------
+def start_tracing(script_globals):
+    global cmds
+    if isinstance(cmds, CmdsTracer):
+        return False
+    cmds = CmdsTracer(cmds, script_globals)
+    script_globals["cmds"] = cmds
+    sys.setprofile(cmds.profile)
+    for listener in list(tracing_listeners):
+        listener()
+    return True
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Returns whether cmds calls are currently being traced for the script whose globals are given, or for any script if
+# none are given
+# ----------------------------------------------------------------------------------------------------------------------
+def is_tracing(script_globals=None):
+    return isinstance(cmds, CmdsTracer) and (script_globals is None or cmds.script_globals is script_globals)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Stops tracing for the script whose globals are given and returns the tracer with everything it recorded. Returns None
+# if that script isn't the one tracing, leaving any other script's trace running.
+# ----------------------------------------------------------------------------------------------------------------------
+def stop_tracing(script_globals):
+    global cmds
+    if not is_tracing(script_globals):
+        return None
+    sys.setprofile(None)
+    tracer = cmds
+    tracer.finish()
+    cmds = tracer.module
+    tracer.script_globals["cmds"] = cmds
+    for listener in list(tracing_listeners):
+        listener()
+    return tracer
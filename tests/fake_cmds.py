@@ -0,0 +1,366 @@
+import copy
+import fnmatch
+import sys
+import types
+
+MATERIAL_TYPES = ("lambert", "blinn", "phong", "aiStandardSurface", "standardSurface")
+SHAPE_TYPES = ("mesh",)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Stand-in for the parts of maya.cmds that Magic Shade's cast engines use, backed by a small in-memory scene. It
+# reproduces the Maya behaviours the engines have to cope with: ls with an empty list lists everything, select raises
+# if nothing matches, sets and listConnections return None rather than empty lists, shading group membership shows up
+# as connections and undo restores the scene as it was when the last undo chunk was opened.
+# ----------------------------------------------------------------------------------------------------------------------
+class FakeCmds(object):
+    def __init__(self):
+        self.new_scene()
+
+    def new_scene(self):
+        self.nodes = {}  # Node type of every node, keyed by full path for DAG nodes and by name for the others
+        self.intermediate = set()
+        self.default_nodes = set()  # Nodes every scene has, such as lambert1 and defaultColorMgtGlobals
+        self.locked_nodes = set()
+        self.members = {}  # Members of every shading group: full shape paths, or full shape paths with components
+        self.connections = []  # (source node, source attribute, destination node, destination attribute)
+        self.attributes = {}  # Value of every (node, attribute)
+        self.selection = []  # (node, component or None)
+        self.undo_chunks = []
+        self.warnings = []
+        self.short_names = None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Scene building
+    # ------------------------------------------------------------------------------------------------------------------
+    def create_node(self, node_type, name, parent=None, intermediate=False, default=False):
+        key = (parent or "") + "|" + name if node_type == "transform" or node_type in SHAPE_TYPES else name
+        self.nodes[key] = node_type
+        if intermediate:
+            self.intermediate.add(key)
+        if default:
+            self.default_nodes.add(key)
+        if node_type == "shadingEngine":
+            self.members[key] = []
+        self.short_names = None
+        return key
+
+    def create_shading_group(self, material, name=None):
+        shading_group = self.create_node("shadingEngine", name or material + "SG")
+        self.connections.append((material, "outColor", shading_group, "surfaceShader"))
+        return shading_group
+
+    def set_members(self, shading_group, members):
+        self.members[shading_group].extend(members)
+
+    def snapshot(self):
+        return copy.deepcopy((self.nodes, self.intermediate, self.default_nodes, self.locked_nodes, self.members,
+                              self.connections, self.attributes, self.selection))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Name resolution
+    # ------------------------------------------------------------------------------------------------------------------
+    def is_dag(self, key):
+        return key.startswith("|")
+
+    def short_name_index(self):
+        if self.short_names is None:
+            self.short_names = {}
+            for key in self.nodes:
+                self.short_names.setdefault(key.rsplit("|", 1)[-1], []).append(key)
+        return self.short_names
+
+    # Returns the shortest unique name of a node, as Maya does
+    def display(self, key):
+        if not self.is_dag(key):
+            return key
+        names = key.lstrip("|").split("|")
+        for length in range(1, len(names) + 1):
+            partial = "|".join(names[-length:])
+            if len([other for other in self.short_name_index().get(names[-1], [])
+                    if other == key or other.endswith("|" + partial)]) == 1:
+                return partial if length < len(names) else key
+        return key
+
+    # Returns the keys of the nodes matching a name pattern, which may be a (partial) DAG path
+    def resolve_nodes(self, pattern):
+        if pattern in self.nodes:
+            return [pattern]
+        if "|" not in pattern:
+            if "*" not in pattern and "?" not in pattern:
+                return list(self.short_name_index().get(pattern, []))
+            return [key for key in self.nodes if fnmatch.fnmatchcase(key.rsplit("|", 1)[-1], pattern)]
+        anchored = pattern.startswith("|")
+        names = pattern.strip("|").split("|")
+        matches = []
+        for key in self.nodes:
+            if not self.is_dag(key):
+                continue
+            path_names = key.lstrip("|").split("|")
+            if len(path_names) < len(names) or (anchored and len(path_names) != len(names)):
+                continue
+            if all(fnmatch.fnmatchcase(path_name, name) for path_name, name in zip(path_names[-len(names):], names)):
+                matches.append(key)
+        return matches
+
+    # Returns (node, attribute or component) items matching a name, plug or component pattern
+    def resolve(self, name):
+        node_pattern, _, suffix = name.partition(".")
+        items = []
+        for key in self.resolve_nodes(node_pattern):
+            if not suffix:
+                items.append((key, None))
+            elif suffix.startswith("f[") or (key, suffix) in self.attributes or self.is_connected(key, suffix):
+                items.append((key, suffix))
+        return items
+
+    def resolve_all(self, names):
+        if isinstance(names, str):
+            names = [names]
+        items = []
+        for name in names:
+            items.extend(self.resolve(name))
+        return items
+
+    def format_item(self, item, long_names=False):
+        key, suffix = item
+        name = key if long_names else self.display(key)
+        return name + "." + suffix if suffix else name
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Connections, including the ones Maya makes for shading group membership
+    # ------------------------------------------------------------------------------------------------------------------
+    def all_connections(self):
+        connections = list(self.connections)
+        for shading_group, members in self.members.items():
+            for shape in set(member.split(".", 1)[0] for member in members):
+                connections.append((shape, "instObjGroups", shading_group, "dagSetMembers"))
+        return connections
+
+    def is_connected(self, node, attribute):
+        return any((source, source_attribute) == (node, attribute) or (destination, destination_attribute) ==
+                   (node, attribute) for source, source_attribute, destination, destination_attribute
+                   in self.connections)
+
+    def shading_groups_of(self, material):
+        return [destination for source, source_attribute, destination, destination_attribute in self.connections
+                if source == material and destination_attribute == "surfaceShader"]
+
+    def surface_material(self, shading_group):
+        for source, source_attribute, destination, destination_attribute in self.connections:
+            if destination == shading_group and destination_attribute == "surfaceShader":
+                return source
+        return None
+
+    # Returns the shapes an item (transform, shape or component) covers when assigning a shader to it
+    def assignable(self, item):
+        key, suffix = item
+        if suffix is not None:
+            return [key + "." + suffix] if self.nodes[key] in SHAPE_TYPES else []
+        if self.nodes[key] in SHAPE_TYPES:
+            return [key] if key not in self.intermediate else []
+        if self.nodes[key] == "transform":
+            return [path for path, node_type in self.nodes.items() if path.startswith(key + "|")
+                    and node_type in SHAPE_TYPES and path not in self.intermediate]
+        return []
+
+    def force_element(self, items, shading_group):
+        for item in items:
+            for member in self.assignable(item):
+                for members in self.members.values():
+                    if "." in member:
+                        members[:] = [other for other in members if other != member]
+                    else:  # Assigning the whole shape replaces any per-face assignments
+                        members[:] = [other for other in members if other.split(".", 1)[0] != member]
+                self.members[shading_group].append(member)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Commands
+    # ------------------------------------------------------------------------------------------------------------------
+    def ls(self, *args, **kwargs):
+        if kwargs.get("selection"):
+            items = list(self.selection)
+        elif args and (args[0] if isinstance(args[0], (list, tuple)) else args):  # Like Maya, [] lists everything
+            items = self.resolve_all(args[0] if isinstance(args[0], (list, tuple)) else list(args))
+        else:
+            items = [(key, None) for key in self.nodes]
+
+        if kwargs.get("assemblies"):
+            items = [item for item in items if self.is_dag(item[0]) and item[0].count("|") == 1]
+        if kwargs.get("dag"):  # Like Maya, listing DAG objects also lists everything below them
+            items = [item for item in items if self.is_dag(item[0])]
+            if args:
+                items = [(key, None) for item in items
+                         for key in [item[0]] + sorted(path for path in self.nodes if path.startswith(item[0] + "|"))]
+        if kwargs.get("shapes"):
+            items = [item for item in items if self.nodes[item[0]] in SHAPE_TYPES]
+        if kwargs.get("noIntermediate"):
+            items = [item for item in items if item[0] not in self.intermediate]
+        if kwargs.get("materials"):
+            items = [item for item in items if self.nodes[item[0]] in MATERIAL_TYPES]
+        if kwargs.get("defaultNodes"):
+            items = [item for item in items if item[0] in self.default_nodes]
+        if kwargs.get("lockedNodes"):
+            items = [item for item in items if item[0] in self.locked_nodes]
+        if "type" in kwargs:
+            items = [item for item in items if self.nodes[item[0]] == kwargs["type"]]
+        if kwargs.get("objectsOnly"):
+            items = [(key, None) for key, suffix in items]
+
+        result = []
+        for item in items:
+            name = self.format_item(item, kwargs.get("long"))
+            if name not in result:
+                result.append(name)
+        return result
+
+    def select(self, *args, **kwargs):
+        if kwargs.get("deselect") and not args:
+            self.selection = []
+            return
+        names = args[0] if args and isinstance(args[0], (list, tuple)) else list(args)
+        items = []
+        for name in names:
+            matches = self.resolve(name)
+            if not matches:
+                raise ValueError("No object matches name: " + name)
+            items.extend(matches)
+        self.selection = items
+
+    def hyperShade(self, objects=None, assign=None):
+        if objects is not None:
+            materials = [key for key, suffix in self.resolve(objects) if self.nodes[key] in MATERIAL_TYPES]
+            self.selection = []
+            for material in materials:
+                for shading_group in self.shading_groups_of(material):
+                    for member in self.members[shading_group]:
+                        key, _, suffix = member.partition(".")
+                        self.selection.append((key, suffix or None))
+        if assign is not None:
+            materials = [key for key, suffix in self.resolve(assign) if self.nodes[key] in MATERIAL_TYPES]
+            if not materials:
+                raise RuntimeError("No shader matches " + assign)
+            shading_groups = self.shading_groups_of(materials[0])
+            shading_group = shading_groups[0] if shading_groups else self.create_shading_group(materials[0])
+            self.force_element(self.selection, shading_group)
+
+    def sets(self, *args, **kwargs):
+        if kwargs.get("query"):
+            members = [self.format_item((key, suffix or None)) for key, _, suffix in
+                       (member.partition(".") for member in self.members[args[0]])]
+            return members or None
+        if kwargs.get("edit"):
+            items = self.resolve_all(args[0])
+            if not items:
+                raise ValueError("No object matches name")
+            self.force_element(items, kwargs["forceElement"])
+            return None
+        name = kwargs.get("name", "set")
+        while name in self.nodes:
+            name += "1"
+        return self.create_node("shadingEngine", name)
+
+    def listConnections(self, objects, type=None, source=True, destination=True, plugs=False):
+        items = self.resolve_all(objects) if objects else list(self.selection)  # Like Maya, [] uses the selection
+        connections = self.all_connections()
+        result = []
+        for key, attribute in items:
+            for connection in connections:
+                source_node, source_attribute, destination_node, destination_attribute = connection
+                if source and destination_node == key and attribute in (None, destination_attribute):
+                    other, other_attribute = source_node, source_attribute
+                elif destination and source_node == key and attribute in (None, source_attribute):
+                    other, other_attribute = destination_node, destination_attribute
+                else:
+                    continue
+                if type is not None and self.nodes[other] != type:
+                    continue
+                result.append(self.display(other) + ("." + other_attribute if plugs else ""))
+        return result or None
+
+    def listHistory(self, nodes):
+        history = []
+        pending = [key for key, suffix in self.resolve_all(nodes)]
+        while pending:
+            node = pending.pop()
+            if node in history:
+                continue
+            history.append(node)
+            pending.extend(source for source, source_attribute, destination, destination_attribute
+                           in self.connections if destination == node)
+        return [self.display(node) for node in history] or None
+
+    def nodeType(self, node):
+        return self.nodes[self.resolve_nodes(node)[0]]
+
+    def objExists(self, name):
+        return bool(self.resolve(name))
+
+    def delete(self, names):
+        keys = set(key for key, suffix in self.resolve_all(names))
+        keys.update([path for path in self.nodes for key in keys if path.startswith(key + "|")])
+        if keys & (self.default_nodes | self.locked_nodes):
+            raise RuntimeError("Cannot delete default or locked nodes: " + ", ".join(sorted(
+                keys & (self.default_nodes | self.locked_nodes))))
+        for key in keys:
+            del self.nodes[key]
+            self.members.pop(key, None)
+        self.intermediate -= keys
+        for members in self.members.values():
+            members[:] = [member for member in members if member.split(".", 1)[0] not in keys]
+        self.connections = [connection for connection in self.connections
+                            if connection[0] not in keys and connection[2] not in keys]
+        self.attributes = dict((plug, value) for plug, value in self.attributes.items() if plug[0] not in keys)
+        self.selection = [item for item in self.selection if item[0] not in keys]
+        self.short_names = None
+
+    def connectAttr(self, source, destination):
+        source_node, source_attribute = source.split(".", 1)
+        destination_node, destination_attribute = destination.split(".", 1)
+        self.connections.append((self.resolve_nodes(source_node)[0], source_attribute,
+                                 self.resolve_nodes(destination_node)[0], destination_attribute))
+
+    def addAttr(self, node, longName, dataType=None):
+        self.attributes[(self.resolve_nodes(node)[0], longName)] = None
+
+    def setAttr(self, plug, value, type=None):
+        items = self.resolve(plug)
+        if not items:
+            raise ValueError("No object matches name: " + plug)
+        self.attributes[items[0]] = value
+
+    def getAttr(self, plug):
+        items = self.resolve(plug)
+        if not items:
+            raise ValueError("No object matches name: " + plug)
+        return self.attributes[items[0]]
+
+    def undoInfo(self, openChunk=False, closeChunk=False, query=False, state=False):
+        if query:
+            return True
+        if openChunk:
+            self.undo_chunks.append(self.snapshot())
+
+    def undo(self):
+        (self.nodes, self.intermediate, self.default_nodes, self.locked_nodes, self.members, self.connections,
+         self.attributes, self.selection) = self.undo_chunks.pop()
+        self.short_names = None
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Installs a FakeCmds as maya.cmds so modules importing it can be loaded outside of Maya, along with a maya.utils whose
+# executeDeferred runs functions straight away. Returns the FakeCmds.
+# ----------------------------------------------------------------------------------------------------------------------
+def install():
+    if "maya.cmds" not in sys.modules:
+        maya = types.ModuleType("maya")
+        maya.cmds = FakeCmds()
+        maya.utils = types.ModuleType("maya.utils")
+        maya.utils.executeDeferred = lambda function, *args: function(*args)
+        sys.modules["maya"] = maya
+        sys.modules["maya.cmds"] = maya.cmds
+        sys.modules["maya.utils"] = maya.utils
+    return sys.modules["maya.cmds"]
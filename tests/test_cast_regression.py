@@ -0,0 +1,254 @@
+# ----------------------------------------------------------------------------------------------------------------------
+# Regression harness for the cast engines. Runs outside of Maya against fake_cmds, casting hum3d.spb and extra Object
+# and Attribute spells on synthetic studio scenes with the legacy engine, cast_spell_list and cast_spellbooks_by_group,
+# and checks that every engine ends up with the same shape -> shader assignments.
+#
+# Run with pytest, or directly to print run time and cmds call ratios on a larger scene:
+#   python tests/test_cast_regression.py [vehicles] [parts per material]
+# ----------------------------------------------------------------------------------------------------------------------
+import os
+import sys
+
+import fake_cmds
+
+cmds = fake_cmds.install()
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+import spellcasting
+
+HUM3D_SPELLBOOK = os.path.join(REPO_DIR, "spellbooks", "hum3d.spb")
+STUDIO_SHADERS = ["Paint_Shader", "Black_Shader", "Window_Shader", "Red_Shader", "Chrome_Shader", "Mirror_Shader",
+                  "Orange_Shader", "Rim_Shader", "Brake_Shader", "Rubber_Shader", "Interior_Shader"]
+VEHICLE_MATERIALS = ["carpaint", "carpaint_second", "windowglass", "redglass", "interior", "interior_second", "chrome",
+                     "clearglass", "mirror", "black", "orangeglass", "rim", "brakedisk", "tire", "darkglass",
+                     "mattemetal", "gray", "glass", "plastic"]
+WHEEL_MATERIALS = ["rim", "brakedisk", "tire"]
+EXTRA_SPELLS = [("*tire*", "*Rubber_Shader*", "Object"),
+                ("Vehicle1|wheels|*rim*", "*Chrome_Shader*", "Object"),
+                ("*glass*", "aiOpaque=false", "Attribute"),
+                ("*Paint_Shader*", "*Black_Shader*", "Shader")]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Scene building
+# ----------------------------------------------------------------------------------------------------------------------
+def create_mesh(name, parent):
+    transform = cmds.create_node("transform", name, parent)
+    shape = cmds.create_node("mesh", name + "Shape", transform)
+    cmds.attributes[(shape, "aiOpaque")] = True
+    return shape
+
+
+# Creates a studio like Arnold_Studio_V3.mb: one shading group per studio shader, mostly empty before a cast, except
+# Rubber_Shader which has none yet. Paint_Shader also feeds a displacement-only shading group. The studio has no file
+# textures, so after a cast every file texture defaultColorMgtGlobals feeds belongs to a replaced material.
+def create_studio():
+    cmds.create_node("lambert", "lambert1", default=True)
+    cmds.create_shading_group("lambert1", "initialShadingGroup")
+    cmds.create_node("shadingEngine", "initialParticleSE", default=True)
+    cmds.default_nodes.add("initialShadingGroup")
+    cmds.create_node("defaultTextureList", "defaultTextureList1", default=True)
+    cmds.create_node("colorManagementGlobals", "defaultColorMgtGlobals", default=True)  # Feeds every file texture
+
+    displacement_group = cmds.create_node("shadingEngine", "Paint_DisplacementSG")
+    for shader in STUDIO_SHADERS:
+        cmds.create_node("aiStandardSurface", shader)
+        if shader == "Paint_Shader":
+            cmds.connections.append((shader, "outColor", displacement_group, "displacementShader"))
+        if shader != "Rubber_Shader":
+            cmds.create_shading_group(shader)
+
+    studio = cmds.create_node("transform", "Studio")
+    cmds.create_node("aiStandardSurface", "Floor_Shader")
+    cmds.set_members(cmds.create_shading_group("Floor_Shader"), [create_mesh("Floor", studio)])
+    cmds.create_node("noise", "shared_noise")  # Used by the floor and every vehicle's paint
+    cmds.connections.append(("shared_noise", "outColor", "Floor_Shader", "bump"))
+
+
+# Creates a vehicle group the way hum3D models import: one material per part type, a textured paint, wheels in their own
+# group and a body with per-face assignments. Part names repeat across vehicles, material names don't.
+def create_vehicle(index, parts):
+    vehicle = cmds.create_node("transform", "Vehicle%d" % index)
+    body = cmds.create_node("transform", "body", vehicle)
+    wheels = cmds.create_node("transform", "wheels", vehicle)
+    for material in VEHICLE_MATERIALS:
+        material_name = "v%d_%s" % (index, material)
+        cmds.create_node("blinn" if material == "plastic" else "phong", material_name)
+        shading_group = cmds.create_shading_group(material_name)
+        parent = wheels if material in WHEEL_MATERIALS else body
+        cmds.set_members(shading_group, [create_mesh("%s_%d" % (material, part), parent) for part in range(parts)])
+
+    texture = cmds.create_node("file", "v%d_carpaint_file" % index)
+    placement = cmds.create_node("place2dTexture", "v%d_carpaint_place2d" % index)
+    cmds.connections.extend([(placement, "outUV", texture, "uvCoord"),
+                             (texture, "outColor", "v%d_carpaint" % index, "color"),
+                             (texture, "message", "defaultTextureList1", "textures"),
+                             ("defaultColorMgtGlobals", "cmEnabled", texture, "colorManagementEnabled"),
+                             ("shared_noise", "outColor", "v%d_carpaint" % index, "bump")])
+
+    shell = create_mesh("shell", body)
+    cmds.create_node("mesh", "shellShapeOrig", body + "|shell", intermediate=True)
+    cmds.set_members("v%d_carpaintSG" % index, [shell + ".f[0:99]"])
+    cmds.set_members("v%d_carpaint_secondSG" % index, [shell + ".f[100:149]"])
+    cmds.set_members("v%d_chromeSG" % index, [shell + ".f[150:199]", create_mesh("Window_frame", body)])
+
+
+def create_scene(vehicles=2, parts=2):
+    cmds.new_scene()
+    create_studio()
+    for index in range(1, vehicles + 1):
+        create_vehicle(index, parts)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Tests
+# ----------------------------------------------------------------------------------------------------------------------
+def assert_engines_match_legacy(spells):
+    legacy_error, results = spellcasting.verify_cast(spells)
+    assert legacy_error is None
+    assert [name for name, engine in spellcasting.VERIFIED_ENGINES] == [result[0] for result in results]
+    for name, error, differences, time_ratio, call_ratio in results:
+        assert error is None, name
+        assert differences == [], name
+
+
+def test_hum3d_matches_legacy():
+    create_scene()
+    assert_engines_match_legacy(spellcasting.read_spellbook(HUM3D_SPELLBOOK))
+
+
+def test_object_attribute_and_chained_spells_match_legacy():
+    create_scene(vehicles=3)
+    assert_engines_match_legacy(spellcasting.read_spellbook(HUM3D_SPELLBOOK) + EXTRA_SPELLS)
+
+
+def test_verify_leaves_scene_unchanged():
+    create_scene()
+    before = cmds.snapshot()
+    spellcasting.verify_cast(spellcasting.read_spellbook(HUM3D_SPELLBOOK) + EXTRA_SPELLS)
+    assert cmds.snapshot() == before
+    assert cmds.undo_chunks == []
+
+
+def test_failing_engine_is_undone_and_reported():
+    def failing_engine(spells):
+        spellcasting.cast_spell_list(spells)
+        raise RuntimeError("Engine failed")
+
+    create_scene()
+    before = cmds.snapshot()
+    assignments, run_time, calls, error = spellcasting.run_cast_engine(
+        failing_engine, spellcasting.read_spellbook(HUM3D_SPELLBOOK))
+    assert assignments is None
+    assert str(error) == "Engine failed"
+    assert cmds.snapshot() == before
+    assert spellcasting.cmds is cmds
+
+
+def test_legacy_error_is_reported_as_not_comparable():
+    create_scene()
+    before = cmds.snapshot()
+    spells = spellcasting.read_spellbook(HUM3D_SPELLBOOK) + [("*nothing*", "*Paint_Shader*", "Object")]
+    legacy_error, results = spellcasting.verify_cast(spells)  # The legacy engine's select raises on no match
+    assert legacy_error is not None
+    for name, error, differences, time_ratio, call_ratio in results:
+        assert error is None, name
+        assert differences is None, name
+    assert cmds.snapshot() == before
+
+
+def test_attribute_spells_matching_nothing_change_nothing():
+    create_scene()
+    before = cmds.snapshot()
+    spellcasting.cast_attribute_spell("*nothing*", "aiOpaque=0")
+    spellcasting.cast_attribute_spell("*Rubber_Shader*", "aiOpaque=0")  # A material without a shading group
+    spellcasting.cast_attribute_spell("*Window_Shader*", "aiOpaque=0")  # A material without members
+    spellcasting.set_attribute([], "aiOpaque=0")
+    assert cmds.snapshot() == before
+
+
+def test_assign_uses_surface_shading_group():
+    create_scene()
+    spellcasting.assign_shader(["|Studio|Floor|FloorShape"], "*Paint_Shader*")
+    assert cmds.members["Paint_ShaderSG"] == ["|Studio|Floor|FloorShape"]
+    assert cmds.members["Paint_DisplacementSG"] == []
+
+
+def test_cleanup_keeps_replacements_shared_textures_and_default_nodes():
+    create_scene()
+    cmds.locked_nodes.add("v2_carpaint_place2d")
+    spells = spellcasting.read_spellbook(HUM3D_SPELLBOOK) + EXTRA_SPELLS
+    spellcasting.delete_orphaned_shaders(spellcasting.cast_spell_list(spells))
+    for node in STUDIO_SHADERS + ["Floor_Shader", "shared_noise", "v1_plastic", "v2_plastic"]:
+        assert cmds.objExists(node), node
+        assert cmds.objExists(node + "SG") or node == "shared_noise", node
+    for node in ["v1_carpaint", "v1_carpaintSG", "v1_carpaint_file", "v1_carpaint_place2d", "v2_tire", "v2_glass"]:
+        assert not cmds.objExists(node), node
+    for node in ["defaultTextureList1", "defaultColorMgtGlobals", "initialParticleSE", "v2_carpaint_place2d"]:
+        assert cmds.objExists(node), node
+
+
+def attribute_values(attribute):
+    return dict((node, value) for (node, node_attribute), value in cmds.attributes.items()
+                if node_attribute == attribute)
+
+
+def test_attribute_spells_match_between_engines():
+    spells = spellcasting.read_spellbook(HUM3D_SPELLBOOK) + EXTRA_SPELLS + [
+        ("*Window*", "aiOpaque=0", "Attribute"), ("Vehicle2|body", "aiOpaque=0", "Attribute")]
+    create_scene()
+    before = attribute_values("aiOpaque")
+    spellcasting.cast_spell_list(spells)
+    expected = attribute_values("aiOpaque")
+    assert expected != before
+    assert not expected["|Vehicle1|body|Window_frame|Window_frameShape"]  # Matched by name
+    assert not expected["|Vehicle2|body|plastic_0|plastic_0Shape"]  # Below a matched group
+    assert expected["|Vehicle1|body|plastic_0|plastic_0Shape"]
+
+    create_scene()
+    spellcasting.cast_spell_list_by_group(spells)
+    assert attribute_values("aiOpaque") == expected
+
+
+def test_make_windows_transparent_only_reaches_window_materials():
+    create_scene()
+    spellcasting.cast_spell_list(spellcasting.read_spellbook(HUM3D_SPELLBOOK))
+    spellcasting.cast_attribute_spell("*Window*", "aiOpaque=False", match_objects=False)
+    opaque = attribute_values("aiOpaque")
+    assert opaque["|Vehicle1|body|Window_frame|Window_frameShape"] is True  # Chrome, despite its name
+    assert opaque["|Vehicle1|body|windowglass_0|windowglass_0Shape"] is False
+    assert opaque["|Vehicle1|body|glass_0|glass_0Shape"] is False
+    assert opaque["|Vehicle1|body|chrome_0|chrome_0Shape"] is True
+
+
+def test_grouped_cleanup_matches_cast_spell_list():
+    spells = spellcasting.read_spellbook(HUM3D_SPELLBOOK) + EXTRA_SPELLS
+    create_scene()
+    spellcasting.delete_orphaned_shaders(spellcasting.cast_spell_list(spells))
+    expected = sorted(cmds.nodes)
+    create_scene()
+    spellcasting.delete_orphaned_shaders(spellcasting.cast_spell_list_by_group(spells))
+    assert sorted(cmds.nodes) == expected
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Prints how each engine compares to the legacy one on a larger scene
+# ----------------------------------------------------------------------------------------------------------------------
+def main(vehicles=10, parts=10):
+    create_scene(vehicles, parts)
+    print("Scene: %d vehicles, %d nodes" % (vehicles, len(cmds.nodes)))
+    legacy_error, results = spellcasting.verify_cast(spellcasting.read_spellbook(HUM3D_SPELLBOOK) + EXTRA_SPELLS)
+    if legacy_error is not None:
+        print("Legacy cast failed: %s" % legacy_error)
+    for name, error, differences, time_ratio, call_ratio in results:
+        if error is not None:
+            print("%s failed: %s" % (name, error))
+        else:
+            print("%s: %d difference(s), run time %.2fx legacy, cmds calls %.2fx legacy" % (
+                name, len(differences) if differences is not None else -1, time_ratio, call_ratio))
+    return 0 if legacy_error is None and all(result[1] is None and result[2] == [] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
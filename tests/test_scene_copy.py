@@ -0,0 +1,73 @@
+# ----------------------------------------------------------------------------------------------------------------------
+# Tests for Vehicular's background copy of saved scenes, run outside of Maya against fake_cmds
+# ----------------------------------------------------------------------------------------------------------------------
+import os
+import sys
+
+import fake_cmds
+
+cmds = fake_cmds.install()
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+import scenecopy
+
+
+def save_scratch(tmp_path, name, contents):
+    scratch_dir = tmp_path / ("scratch_" + name)
+    scratch_dir.mkdir()
+    scratch = scratch_dir / name
+    scratch.write_bytes(contents)
+    return str(scratch)
+
+
+def wait_for_queue():
+    thread = scenecopy.copy_thread
+    if thread is not None:
+        thread.join(10)
+    assert scenecopy.copy_thread is None
+    assert not scenecopy.copy_queue
+
+
+def test_copy_replaces_destination_and_removes_scratch(tmp_path):
+    destination = tmp_path / "car_Arnold.mb"
+    destination.write_bytes(b"old scene")
+    scratch = save_scratch(tmp_path, "car_Arnold.mb", b"new scene")
+    scenecopy.queue_copy(scratch, str(destination))
+    wait_for_queue()
+    assert destination.read_bytes() == b"new scene"
+    assert not os.path.exists(str(destination) + ".tmp")
+    assert not os.path.exists(os.path.dirname(scratch))
+
+
+def test_missing_source_does_not_stop_later_copies(tmp_path, monkeypatch):
+    monkeypatch.setattr(scenecopy.time, "sleep", lambda seconds: None)
+    cmds.warnings = []
+    missing_destination = tmp_path / "missing_Arnold.mb"
+    good_destination = tmp_path / "good_Arnold.mb"
+    with scenecopy.copy_lock:  # Queue both before the worker starts so the good copy runs after the failed one
+        scenecopy.copy_queue.append((str(tmp_path / "gone" / "missing_Arnold.mb"), str(missing_destination)))
+    scenecopy.queue_copy(save_scratch(tmp_path, "good_Arnold.mb", b"good scene"), str(good_destination))
+    wait_for_queue()
+    assert not missing_destination.exists()
+    assert good_destination.read_bytes() == b"good scene"
+    assert len(cmds.warnings) == 1 and "missing_Arnold.mb" in cmds.warnings[0]
+
+
+def test_unexpected_error_is_reported_and_queue_continues(tmp_path, monkeypatch):
+    copy_verified = scenecopy.copy_verified
+
+    def failing_copy(source, destination):
+        if "bad" in destination:
+            raise RuntimeError("Unexpected")
+        copy_verified(source, destination)
+
+    monkeypatch.setattr(scenecopy, "copy_verified", failing_copy)
+    cmds.warnings = []
+    good_destination = tmp_path / "good_Arnold.mb"
+    with scenecopy.copy_lock:
+        scenecopy.copy_queue.append(("bad_scratch.mb", str(tmp_path / "bad_Arnold.mb")))
+    scenecopy.queue_copy(save_scratch(tmp_path, "good_Arnold.mb", b"good scene"), str(good_destination))
+    wait_for_queue()
+    assert good_destination.read_bytes() == b"good scene"
+    assert len(cmds.warnings) == 1 and "Unexpected" in cmds.warnings[0]
@@ -0,0 +1,92 @@
+# ----------------------------------------------------------------------------------------------------------------------
+# Tests for reading spellbooks: includes, overrides and the spellbook cache
+# ----------------------------------------------------------------------------------------------------------------------
+import os
+import sys
+
+import pytest
+
+import fake_cmds
+
+fake_cmds.install()
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+import spellcasting
+
+
+def write_spellbook(directory, name, lines):
+    path = directory / name
+    path.write_text("".join(line + "\n" for line in lines))
+    return str(path)
+
+
+def test_flat_spellbook_keeps_every_row(tmp_path):
+    path = write_spellbook(tmp_path, "flat.spb", ["*Window*:aiOpaque=0:Attribute",
+                                                  "*Window*:visibility=1:Attribute",
+                                                  "*tire*:*Rubber_Shader*:Shader",
+                                                  "*tire*:*Black_Shader*:Shader"])
+    assert spellcasting.read_spellbook(path) == [("*Window*", "aiOpaque=0", "Attribute"),
+                                                 ("*Window*", "visibility=1", "Attribute"),
+                                                 ("*tire*", "*Rubber_Shader*", "Shader"),
+                                                 ("*tire*", "*Black_Shader*", "Shader")]
+    assert spellcasting.is_flat_spellbook(path)
+
+
+def test_include_is_read_in_place_and_overridden(tmp_path):
+    write_spellbook(tmp_path, "base.spb", ["*carpaint*:*Paint_Shader*:Shader",
+                                           "*glass*:*Window_Shader*:Shader",
+                                           "*Window*:aiOpaque=0:Attribute"])
+    path = write_spellbook(tmp_path, "make.spb", ["# Per-make overrides",
+                                                  "*chrome*:*Chrome_Shader*:Shader",
+                                                  "include:base.spb",
+                                                  "*carpaint*:*Red_Shader*:Shader",
+                                                  "*Window*:aiOpaque=1:Attribute",
+                                                  "*Window*:visibility=1:Attribute",
+                                                  "*chrome*:*Mirror_Shader*:Shader"])
+    assert spellcasting.read_spellbook(path) == [("*chrome*", "*Chrome_Shader*", "Shader"),
+                                                 ("*carpaint*", "*Red_Shader*", "Shader"),
+                                                 ("*glass*", "*Window_Shader*", "Shader"),
+                                                 ("*Window*", "aiOpaque=1", "Attribute"),
+                                                 ("*Window*", "visibility=1", "Attribute"),
+                                                 ("*chrome*", "*Mirror_Shader*", "Shader")]
+    assert not spellcasting.is_flat_spellbook(path)
+
+
+def test_nested_includes_override_outward(tmp_path):
+    write_spellbook(tmp_path, "base.spb", ["*tire*:*Rubber_Shader*:Shader"])
+    os.mkdir(str(tmp_path / "makes"))
+    write_spellbook(tmp_path / "makes", "make.spb", ["include:../base.spb", "*tire*:*Black_Shader*:Shader"])
+    path = write_spellbook(tmp_path, "model.spb", ["include:makes/make.spb", "*tire*:*Chrome_Shader*:Shader"])
+    assert spellcasting.read_spellbook(path) == [("*tire*", "*Chrome_Shader*", "Shader")]
+
+
+def test_include_path_with_drive_letter(tmp_path):
+    drive_dir = tmp_path / "C:"  # Stands in for a Windows drive; the include path keeps everything after "include:"
+    drive_dir.mkdir()
+    base_path = write_spellbook(drive_dir, "base.spb", ["*tire*:*Rubber_Shader*:Shader"])
+    path = write_spellbook(tmp_path, "make.spb", ["include:" + base_path])
+    assert spellcasting.read_spellbook(path) == [("*tire*", "*Rubber_Shader*", "Shader")]
+
+
+def test_include_cycle_is_reported(tmp_path):
+    write_spellbook(tmp_path, "a.spb", ["include:b.spb"])
+    write_spellbook(tmp_path, "b.spb", ["*tire*:*Rubber_Shader*:Shader", "include:a.spb"])
+    with pytest.raises(ValueError):
+        spellcasting.read_spellbook(str(tmp_path / "a.spb"))
+
+
+def test_cache_is_invalidated_when_an_included_file_changes(tmp_path):
+    base_path = write_spellbook(tmp_path, "base.spb", ["*tire*:*Rubber_Shader*:Shader"])
+    path = write_spellbook(tmp_path, "make.spb", ["include:base.spb"])
+    spells = spellcasting.read_spellbook(path)
+    assert spellcasting.read_spellbook(path) is spells  # Unchanged files are read from the cache
+
+    write_spellbook(tmp_path, "base.spb", ["*tire*:*Black_Shader*:Shader", "*rim*:*Rim_Shader*:Shader"])
+    os.utime(base_path, (os.path.getatime(base_path), os.path.getmtime(base_path) + 10))
+    assert spellcasting.read_spellbook(path) == [("*tire*", "*Black_Shader*", "Shader"),
+                                                 ("*rim*", "*Rim_Shader*", "Shader")]
+
+    os.remove(base_path)
+    with pytest.raises((IOError, OSError)):
+        spellcasting.read_spellbook(path)
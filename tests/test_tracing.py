@@ -0,0 +1,39 @@
+# ----------------------------------------------------------------------------------------------------------------------
+# Tests for tracing cmds calls when both Magic Shade and Vehicular are open
+# ----------------------------------------------------------------------------------------------------------------------
+import os
+import sys
+
+import fake_cmds
+
+cmds = fake_cmds.install()
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+import spellcasting
+
+
+def test_only_one_script_traces_at_a_time():
+    magic_shade_globals = {"cmds": cmds}
+    vehicular_globals = {"cmds": cmds}
+    notifications = []
+    spellcasting.tracing_listeners.append(lambda: notifications.append(spellcasting.is_tracing()))
+    try:
+        assert spellcasting.start_tracing(vehicular_globals)
+        assert not spellcasting.start_tracing(magic_shade_globals)
+        assert magic_shade_globals["cmds"] is cmds
+        assert spellcasting.is_tracing() and not spellcasting.is_tracing(magic_shade_globals)
+
+        assert spellcasting.stop_tracing(magic_shade_globals) is None  # Leaves Vehicular's trace running
+        assert isinstance(vehicular_globals["cmds"], spellcasting.CmdsTracer)
+
+        spellcasting.cast_attribute_spell("*nothing*", "aiOpaque=0")
+        tracer = spellcasting.stop_tracing(vehicular_globals)
+        assert any(event["name"] == "cmds.ls" for event in tracer.events)
+        assert vehicular_globals["cmds"] is cmds and spellcasting.cmds is cmds
+        assert not spellcasting.is_tracing()
+        assert notifications == [True, False]
+    finally:
+        spellcasting.tracing_listeners.pop()
+        if spellcasting.is_tracing():
+            spellcasting.stop_tracing(spellcasting.cmds.script_globals)
@@ -1,6 +1,8 @@
 import fileinput
 import os
+import re
 import sys
+import tempfile
 
 import maya.OpenMayaUI as mui
 import maya.cmds as cmds
@@ -9,6 +11,13 @@ from PySide2.QtGui import *
 from PySide2.QtWidgets import *
 from shiboken2 import wrapInstance
 
+# Shared spell casting code lives next to this script in the install folder
+SCRIPT_DIR = os.path.expanduser("~/maya/scripts/magic-shade")
+if SCRIPT_DIR not in sys.path:
+    sys.path.append(SCRIPT_DIR)
+import scenecopy
+import spellcasting
+
 SCRIPT_NAME = "Vehicular"
 
 
@@ -106,6 +115,8 @@ class MainUI(QDialog):
                                                            "Make Windows Transparent")
         self.make_windows_transparent_button.setMinimumHeight(UI_ELEMENT_HEIGHT)
 
+        self.trace_checkbox = QCheckBox("Trace cmds Calls")
+
         self.save_button = QPushButton(QIcon(self.icon_dir + "/save_as.png"), "Save As...")
         self.save_button.setMinimumHeight(UI_ELEMENT_HEIGHT)
 
@@ -142,6 +153,7 @@ class MainUI(QDialog):
         tools_layout = QVBoxLayout()
         tools_layout.addWidget(self.remove_license_plate_button)
         tools_layout.addWidget(self.make_windows_transparent_button)
+        tools_layout.addWidget(self.trace_checkbox)
         tools_group.setLayout(tools_layout)
         main_layout.addWidget(tools_group)
 
@@ -159,6 +171,9 @@ class MainUI(QDialog):
         self.apply_spellbook_button.clicked.connect(self.apply_spellbook)
         self.remove_license_plate_button.clicked.connect(self.remove_license_plate)
         self.make_windows_transparent_button.clicked.connect(self.make_windows_transparent)
+        self.trace_checkbox.toggled.connect(self.toggle_tracing)
+        spellcasting.tracing_listeners.append(self.tracing_changed)  # Disabled while Magic Shade is tracing
+        self.tracing_changed()
         self.save_button.clicked.connect(self.save)
 
     def load_studio(self):
@@ -190,7 +205,13 @@ class MainUI(QDialog):
             diff = [x for x in new_all_objects if x not in prev_all_objects]
             # print(str(diff))
 
-            cmds.group(diff, name="Vehicle")
+            vehicle_group = cmds.group(diff, name="Vehicle")
+
+            # Remember which spellbook this vehicle should be cast with, so vehicles can each have their own
+            spellbook_path = self.choose_spellbook_edit.text()
+            if os.path.isfile(spellbook_path):
+                cmds.addAttr(vehicle_group, longName="spellbook", dataType="string")
+                cmds.setAttr(vehicle_group + ".spellbook", spellbook_path, type="string")
 
             cmds.scale(0.0328, 0.0328, 0.0328, absolute=True, pivot=(0, 0, 0))
 
@@ -226,48 +247,104 @@ class MainUI(QDialog):
 
     def apply_spellbook(self):
         spellbook_path = self.choose_spellbook_edit.text()
+
+        # Vehicles are each cast with the spellbook they were loaded with (or the chosen one), all in one pass
+        tagged_groups = cmds.ls("*.spellbook", objectsOnly=True, long=True) or []
+        vehicle_groups = self.vehicle_groups(tagged_groups)
+        if vehicle_groups:
+            spellbook_paths = {}
+            for vehicle_group in vehicle_groups:
+                tag = cmds.getAttr(vehicle_group + ".spellbook") if vehicle_group in tagged_groups else None
+                spellbook_paths[vehicle_group] = tag or spellbook_path
+
+            # Vehicles loaded with a different spellbook may just have picked up the last one used, so ask
+            different_groups = [vehicle_group for vehicle_group in vehicle_groups
+                                if not self.same_path(spellbook_paths[vehicle_group], spellbook_path)]
+            if different_groups and os.path.isfile(spellbook_path):
+                vehicle_list = "\n".join("%s: %s" % (vehicle_group.lstrip("|"),
+                                                     os.path.basename(spellbook_paths[vehicle_group]))
+                                         for vehicle_group in different_groups)
+                answer = QMessageBox.question(
+                    self, "Different Spellbooks",
+                    "These vehicles were loaded with a different spellbook:\n\n%s\n\nCast them with their own "
+                    "spellbooks? Choosing No casts every vehicle with %s." % (vehicle_list,
+                                                                             os.path.basename(spellbook_path)),
+                    QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+                if answer == QMessageBox.Cancel:
+                    return
+                if answer == QMessageBox.No:
+                    for vehicle_group in different_groups:
+                        spellbook_paths[vehicle_group] = spellbook_path
+
+            spellbooks_by_group = {}
+            for vehicle_group in vehicle_groups:
+                if not os.path.isfile(spellbook_paths[vehicle_group]):
+                    warning_box = QMessageBox(QMessageBox.Warning, "No Spellbook Found",
+                                              "No spellbook file found at %s for %s." % (
+                                                  spellbook_paths[vehicle_group], vehicle_group.lstrip("|")))
+                    warning_box.exec_()
+                    return
+                spellbooks_by_group[vehicle_group] = spellcasting.read_spellbook(spellbook_paths[vehicle_group])
+            replaced_groups = spellcasting.cast_spellbooks_by_group(spellbooks_by_group)
+            spellcasting.delete_orphaned_shaders(replaced_groups)  # Remove replaced materials before saving
+            return
+
         if os.path.isfile(spellbook_path):
             selection = cmds.ls(selection=True)
             cmds.select(deselect=True)
-            with open(spellbook_path) as f:
-                data = f.read().splitlines()
-                for spell in data:
-                    spell_split = spell.split(":")
-                    original = spell_split[0]
-                    replacement = spell_split[1]
-                    spell_type = spell_split[2]
-
-                    # print("Replacing " + original + " " + spell_type + " with " + replacement)
-                    if spell_type == "Shader":
-                        cmds.hyperShade(objects=original)
-                    elif spell_type == "Object":
-                        cmds.select(original, replace=True)
-                    else:
-                        raise ValueError(
-                            "Spell type invalid. Should be one of the following: " + str(self.types_model.stringList()))
-                    cmds.hyperShade(assign=replacement)
-                    cmds.select(deselect=True)
+            replaced_groups = spellcasting.cast_spell_list(spellcasting.read_spellbook(spellbook_path))
+            spellcasting.delete_orphaned_shaders(replaced_groups)  # Remove replaced materials before saving
             cmds.select(selection)
         else:
             warning_box = QMessageBox(QMessageBox.Warning, "No Spellbook Found",
                                       "No spellbook file (*.spb) found at the specified path.")
             warning_box.exec_()
 
+    # Returns the groups load_vehicle created: top-level groups named Vehicle, Vehicle1... and groups tagged with a
+    # spellbook, leaving out any group inside another one (e.g. a tagged group reparented under a vehicle) so that no
+    # shape is cast twice
+    def vehicle_groups(self, tagged_groups):
+        named_groups = [group for group in cmds.ls(assemblies=True, type="transform", long=True) or []
+                        if re.match(r"\|Vehicle\d*$", group)]
+        vehicle_groups = []
+        for group in sorted(set(tagged_groups + named_groups)):  # Sorted so groups come before everything inside them
+            if not any(group.startswith(vehicle_group + "|") for vehicle_group in vehicle_groups):
+                vehicle_groups.append(group)
+        return vehicle_groups
+
+    def same_path(self, path, other_path):
+        return os.path.normcase(os.path.abspath(path)) == os.path.normcase(os.path.abspath(other_path))
+
     def remove_license_plate(self):
         cmds.delete("LicPlate*")
 
     def make_windows_transparent(self):
-        selection = cmds.ls(selection=True)
+        # Only objects whose material matches, so e.g. a chrome Window_frame stays opaque
+        spellcasting.cast_attribute_spell("*Window*", "aiOpaque=False", match_objects=False)
+
+    def toggle_tracing(self, checked):
+        if checked:
+            if not spellcasting.start_tracing(globals()):
+                cmds.warning("Another tool is already tracing cmds calls")
+                self.trace_checkbox.setChecked(False)
+            return
 
-        cmds.select(deselect=True)
-        cmds.hyperShade(objects="*Window*")
-        windows = cmds.ls(selection=True)
-        cmds.select(deselect=True)
+        tracer = spellcasting.stop_tracing(globals())
+        if tracer is None:  # Unchecked because tracing couldn't start
+            return
+        file_path = QFileDialog.getSaveFileName(None, "", "", "Chrome Trace (*.json)")[0]
+        if file_path == "":
+            return
+        tracer.export(file_path)
 
-        for window in windows:
-            cmds.setAttr(window + ".aiOpaque", False)
+    def tracing_changed(self):
+        self.trace_checkbox.setEnabled(not spellcasting.is_tracing() or spellcasting.is_tracing(globals()))
 
-        cmds.select(selection)
+    def closeEvent(self, event):
+        spellcasting.tracing_listeners.remove(self.tracing_changed)
+        if spellcasting.stop_tracing(globals()) is not None:  # Otherwise every Python call in Maya stays profiled
+            print("Stopped tracing, the trace was discarded")
+        super(MainUI, self).closeEvent(event)
 
     def save(self):
         filename, file_extension = os.path.splitext(self.choose_vehicle_edit.text())
@@ -275,8 +352,14 @@ class MainUI(QDialog):
         if save_as_filename == "":
             return
 
-        cmds.file(rename=save_as_filename)
+        # Save to local scratch first, then copy to the (usually network) destination in the background so the next
+        # vehicle can be worked on while the copy runs
+        scratch_filename = os.path.join(tempfile.mkdtemp(prefix="vehicular_"), os.path.basename(save_as_filename))
+        cmds.file(rename=scratch_filename)
         cmds.file(save=True, type="mayaBinary")
+        cmds.file(rename=save_as_filename)
+
+        scenecopy.queue_copy(scratch_filename, save_as_filename)
 
 
 # Dev code to automatically close old windows when running